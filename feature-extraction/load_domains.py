@@ -56,10 +56,16 @@ def main():
     else:
         final_domains = mongo_domains
 
-    # Write final domain list to file
-    with open(args.output_file, 'w') as file:
-        for domain in sorted(final_domains):
-            file.write(domain + '\n')
+    # Write final domain list to file as a single payload
+    payload = ('\n'.join(sorted(final_domains)) + '\n').encode('utf-8') if final_domains else b''
+    fd = os.open(args.output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(payload)
+        # os.write may write less than requested, continue with the rest
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
     print(f'Domains have been processed and saved to {args.output_file}')
 
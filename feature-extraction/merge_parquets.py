@@ -2,38 +2,116 @@
 
 import sys
 import argparse
-import pandas as pd
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 
+# Read buffer for column chunks, large enough to span many pages per IO request
+READ_BUFFER_SIZE = 8 << 20
+# Rows per record batch streamed from the input files
+BATCH_SIZE = 65536
+# Rows per temporary shard when shuffling, every shard is permuted in memory on its own
+SHUFFLE_SHARD_ROWS = 1 << 20
+# Rows of a shard buffered before they are written out as one part of the shard
+SHUFFLE_FLUSH_ROWS = 65536
+# Rows buffered across all shards before the largest buffer is written out
+SHUFFLE_BUFFER_ROWS = 4 << 20
+
+def open_parquet(file):
+    # Pre-buffering fetches all column chunks of a row group in a few coalesced reads,
+    # which saves round trips on network and object storage
+    return pq.ParquetFile(file, pre_buffer=True, buffer_size=READ_BUFFER_SIZE)
+
+def data_columns(schema):
+    # Columns of the schema without the index stored by pandas
+    index_columns = (schema.pandas_metadata or {}).get('index_columns', [])
+    return [name for name in schema.names if name not in index_columns]
+
+def shuffle_tables(tables, schema, num_rows, writer, temp_dir):
+    # Scatter the rows to random shards on disk, then shuffle each shard in memory,
+    # which yields a uniform permutation of all rows; at most SHUFFLE_BUFFER_ROWS rows
+    # are buffered while scattering and a single shard is held while shuffling
+    rng = np.random.default_rng()
+    num_shards = max(1, -(-num_rows // SHUFFLE_SHARD_ROWS))
+
+    # The rows of every shard are buffered and written in parts, so that the parts have
+    # large row groups and no file is kept open between the writes
+    buffers = [[] for _ in range(num_shards)]
+    buffered_rows = np.zeros(num_shards, dtype=np.int64)
+    part_files = [[] for _ in range(num_shards)]
+
+    def flush(shard):
+        file = os.path.join(temp_dir, f"shard-{shard}-{len(part_files[shard])}.parquet")
+        pq.write_table(pa.concat_tables(buffers[shard]), file, compression='snappy')
+        part_files[shard].append(file)
+        buffers[shard], buffered_rows[shard] = [], 0
+
+    for table in tables:
+        shards = rng.integers(num_shards, size=table.num_rows)
+        order = np.argsort(shards, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(shards, minlength=num_shards))])
+        for shard in np.flatnonzero(np.diff(offsets)):
+            # take() copies the rows of the shard, the batch is not kept alive by the buffers
+            buffers[shard].append(table.take(order[offsets[shard]:offsets[shard + 1]]))
+            buffered_rows[shard] += offsets[shard + 1] - offsets[shard]
+            if buffered_rows[shard] >= SHUFFLE_FLUSH_ROWS:
+                flush(shard)
+        while buffered_rows.sum() > SHUFFLE_BUFFER_ROWS:
+            flush(int(np.argmax(buffered_rows)))
+
+    for shard in range(num_shards):
+        if buffers[shard]:
+            flush(shard)
+
+    for shard in range(num_shards):
+        if part_files[shard]:
+            shard_table = pa.concat_tables([pq.read_table(file) for file in part_files[shard]])
+            writer.write_table(shard_table.take(rng.permutation(shard_table.num_rows)))
+            del shard_table
+        for file in part_files[shard]:
+            os.remove(file)
+
 def merge_parquet_files(input_files, output_file, shuffle=False):
-    # Load the first file to get column names and types
-    first_file = input_files[0]
-    df_first = pd.read_parquet(first_file)
-
-    # Initialize merged DataFrame
-    merged_df = df_first
-
-    # Merge the rest of the files
-    for file in input_files[1:]:
-        df = pd.read_parquet(file)
-        
-        # Check if column names match
-        if set(df.columns) != set(df_first.columns):
+    # Check column names and unify column types using only the file footers,
+    # the first file gives the column order
+    files = [open_parquet(file) for file in input_files]
+    columns = data_columns(files[0].schema_arrow)
+    schemas = []
+    for file, parquet_file in zip(input_files, files):
+        file_schema = parquet_file.schema_arrow
+        if set(data_columns(file_schema)) != set(columns):
             print(f"Error: Column names do not match in file {file}")
             sys.exit(1)
-        
-        # Rearrange columns if necessary
-        df = df[df_first.columns]
-
-        # Append to merged DataFrame
-        merged_df = pd.concat([merged_df, df], ignore_index=True)
+        schemas.append(pa.schema([file_schema.field(name) for name in columns], metadata=file_schema.metadata))
+    schema = pa.unify_schemas(schemas, promote_options="permissive")
 
-    # Shuffle rows if specified
-    if shuffle:
-        merged_df = merged_df.sample(frac=1).reset_index(drop=True)
+    # Stream record batches one row group at a time, pre-buffering over the whole file
+    # would fetch all of its row groups up front
+    tables = (pa.Table.from_batches([batch]).select(columns).cast(schema)
+              for parquet_file in files
+              for row_group in range(parquet_file.num_row_groups)
+              for batch in parquet_file.iter_batches(batch_size=BATCH_SIZE, columns=columns, row_groups=[row_group]))
 
-    # Write merged DataFrame to parquet file
-    merged_df.to_parquet(output_file)
+    # The output may be one of the inputs, which are still being read, so it is written
+    # to a temporary file next to it that replaces it at the end
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    temp_output_file = os.path.join(output_dir, f".{os.path.basename(output_file)}.{os.getpid()}.tmp")
+    try:
+        with pq.ParquetWriter(temp_output_file, schema, compression='snappy') as writer:
+            if shuffle:
+                num_rows = sum(parquet_file.metadata.num_rows for parquet_file in files)
+                with tempfile.TemporaryDirectory(dir=output_dir) as temp_dir:
+                    shuffle_tables(tables, schema, num_rows, writer, temp_dir)
+            else:
+                for table in tables:
+                    writer.write_table(table)
+        os.replace(temp_output_file, output_file)
+    except BaseException:
+        if os.path.exists(temp_output_file):
+            os.remove(temp_output_file)
+        raise
 
     print(f"Merged files saved to {output_file}")
 
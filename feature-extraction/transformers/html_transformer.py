@@ -1,26 +1,23 @@
+import io
+import os
 import re
+import shutil
 from collections import Counter, OrderedDict
+from itertools import chain
 from typing import Iterable
-import gzip
-from bs4 import BeautifulSoup
-from pandas import DataFrame, notnull, concat
-from joblib import Parallel, delayed
-import signal
-from multiprocessing import TimeoutError
-
-class Timeout:
-    def __init__(self, seconds=600, error_message="Timeout occurred"):
-        self.seconds = seconds
-        self.error_message = error_message
-
-    def __enter__(self):
-        def handler(signum, frame):
-            raise TimeoutError(self.error_message)
-        signal.signal(signal.SIGALRM, handler)
-        signal.alarm(self.seconds)
-
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # ISA-L's SIMD inflate, a drop-in replacement for the standard gzip module
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+from lxml import etree
+import numpy as np
+from pandas import DataFrame, Series, notnull, concat, factorize
+import pyarrow as pa
+import pyarrow.compute as pc
+from joblib import Parallel, delayed, effective_n_jobs
+from multiprocessing.shared_memory import SharedMemory
 
 HTML_FEATURE_COLUMNS = [
     "html_num_of_tags", "html_num_of_paragraphs", "html_num_of_divs", "html_num_of_titles",
@@ -47,250 +44,461 @@ HTML_FEATURE_COLUMNS = [
     "html_window_set_interval", "html_hex_encoding", "html_unicode_encoding", "html_long_variable_name"
 ]
 
+# threads decompressing the HTML of a chunk, inflating runs outside of the GIL
+DECOMPRESS_THREADS = 8
+
+# documents larger than this once decompressed are not processed, all of their HTML features are -1
+MAX_HTML_BYTES = 5 << 20
+
 def decompress_html(compressed_html: bytes) -> str:
     """
     Decompress a gzip-compressed HTML string and decode it to UTF-8.
     """
     try:
         if compressed_html:
-            return gzip.decompress(compressed_html).decode('utf-8')
+            # Inflate at most one byte over the limit, so that a gzip bomb cannot exhaust the memory
+            with gzip.GzipFile(fileobj=io.BytesIO(compressed_html)) as file:
+                html = file.read(MAX_HTML_BYTES + 1)
+            if len(html) > MAX_HTML_BYTES:
+                print(f"Skipping HTML of more than {MAX_HTML_BYTES} bytes")
+                return None
+            return html.decode('utf-8')
         else:
             return None
     except Exception as e:
         print(f"Error decompressing HTML: {e}")
         return None
 
-_patterns = OrderedDict({
-    "createElement": re.compile(r"(createElement\()"),
-    "write": re.compile(r"(write\()"),
-    "charCodeAt": re.compile(r"(charCodeAt\()"),
-    "concat": re.compile(r"(concat\()"),
-    "escape": re.compile(r"((?<!n)escape\()"),
-    "eval": re.compile(r"(eval\()"),
-    "exec": re.compile(r"(exec\()"),
-    "fromCharCode": re.compile(r"(fromCharCode\()"),
-    "link": re.compile(r"(link\()"),
-    "parseInt": re.compile(r"(parseInt\()"),
-    "replace": re.compile(r"(replace\()"),
-    "search": re.compile(r"(search\()"),
-    "substring": re.compile(r"(substring\()"),
-    "unescape": re.compile(r"(unescape\()"),
-    "addEventListener": re.compile(r"(addEventListener\()"),
-    "setInterval": re.compile(r"(setInterval\()"),
-    "setTimeout": re.compile(r"(setTimeout\()"),
-    "push": re.compile(r"(push\()"),
-    "indexOf": re.compile(r"(indexOf\()"),
-    "documentWrite": re.compile(r"(document\.write\()"),
-    "get": re.compile(r"(get\()"),
-    "find": re.compile(r"(find\()"),
-    "documentCreateElement": re.compile(r"(document\.createElement\()"),
-    "windowSetTimeout": re.compile(r"(window\.setTimeout\()"),
-    "windowSetInterval": re.compile(r"(window\.setInterval\()"),
-    "hexEncoding": re.compile(r'\\x[0-9A-Fa-f]{2}'),
-    "unicodeEncoding": re.compile(r'\\u[0-9A-Fa-f]{4}'),
-    "longVariableName": re.compile(r'\b[a-zA-Z0-9_]{20,}\b')
+# calls counted in inline scripts, in the order of the html_* JS feature columns; the patterns
+# are plain literals, so str.count() finds the same non-overlapping matches as re.findall()
+# with a single substring search per call instead of a regex scan of the script text
+_js_calls = OrderedDict({
+    "createElement": "createElement(",
+    "write": "write(",
+    "charCodeAt": "charCodeAt(",
+    "concat": "concat(",
+    "escape": "escape(",
+    "eval": "eval(",
+    "exec": "exec(",
+    "fromCharCode": "fromCharCode(",
+    "link": "link(",
+    "parseInt": "parseInt(",
+    "replace": "replace(",
+    "search": "search(",
+    "substring": "substring(",
+    "unescape": "unescape(",
+    "addEventListener": "addEventListener(",
+    "setInterval": "setInterval(",
+    "setTimeout": "setTimeout(",
+    "push": "push(",
+    "indexOf": "indexOf(",
+    "documentWrite": "document.write(",
+    "get": "get(",
+    "find": "find(",
+    "documentCreateElement": "document.createElement(",
+    "windowSetTimeout": "window.setTimeout(",
+    "windowSetInterval": "window.setInterval(",
 })
 
-_text_patterns = (
-    re.compile(r"\b(suspended|blocked|forbidden|denied|restricted)\b", re.IGNORECASE),
-    re.compile(r'\s{2,}')
-)
+# escape( preceded by an n, as in unescape(, is not counted as an escape call
+_js_escape_exclusion = "nescape("
+
+_js_encodings_pattern = re.compile(r'(?P<hexEncoding>\\x[0-9A-Fa-f]{2})|(?P<unicodeEncoding>\\u[0-9A-Fa-f]{4})')
+# kept apart from the encodings, a word may start right after an escape sequence
+_js_long_variable_name_pattern = re.compile(r'\b[a-zA-Z0-9_]{20,}\b')
+
+_js_features = [*_js_calls, "hexEncoding", "unicodeEncoding", "longVariableName"]
+
+# Python's str.isspace() and str.splitlines() characters spelled out for RE2, whose \s and \b are ASCII-only
+_whitespace_chars = r'\t-\r\x1c-\x20\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}'
+_line_break_chars = r'\n\v\f\r\x1c-\x1e\x{85}\x{2028}\x{2029}'
+_word_chars = r'\p{L}\p{N}_'
+
+_text_patterns = {
+    "line_break": rf'\r\n|[{_line_break_chars}]',
+    "trailing_line_break": rf'[{_line_break_chars}]$',
+    "blank_spaces": rf'[{_whitespace_chars}]{{2,}}',
+    "blocked_keywords": rf'(?:^|[^{_word_chars}])(?:suspended|blocked|forbidden|denied|restricted)(?:$|[^{_word_chars}])',
+}
+
+# (tag, attribute) pairs whose elements are collected while walking the tree, i.e. the elements
+# of the given tag that carry the attribute; attribute names are matched literally
+_attribute_queries = {
+    'script': ('src', 'async', 'type'),
+    'a': ('href="#"', 'href="#content"', 'href="javascript:void(0)"'),
+    'input': ('type="password"',),
+    'iframe': ('src',),
+    'img': ('src',),
+    'link': ('href', 'type', 'type="application/rss+xml"', 'rel="shortlink"', 'rel="shortcut icon"',
+             'rel="stylesheet"'),
+    'form': ('action',),
+}
+
+# huge_tree lifts libxml2's nesting limit of 255 levels to 2048, pages with long runs of
+# unclosed elements would otherwise lose everything past that depth
+_html_parser = etree.HTMLParser(encoding='utf-8', huge_tree=True)
+
+# stands in for documents libxml2 yields no tree for (empty, blank or comment-only), it has no elements
+_empty_document = etree.Element('html')
+
+
+def parse_html(html: str):
+    """
+    Parse a decompressed HTML document into an lxml element tree and return its root element.
+    Unlike html.parser, libxml2 adds the implied html and body elements (and, in libxml2 < 2.14,
+    a p around bare top-level text), which are counted among the tags of the document.
+    """
+    try:
+        root = etree.fromstring(html.encode('utf-8'), _html_parser)
+        # libxml2 stops building the tree without raising when a limit is exceeded, e.g. nesting
+        # deeper than 2048 levels, a truncated tree is treated as a parsing error
+        fatal_errors = [error.message for error in _html_parser.error_log if error.level == etree.ErrorLevels.FATAL]
+        if fatal_errors:
+            print(f"Error parsing HTML: {fatal_errors[0]}")
+            return None
+        return root if root is not None else _empty_document
+    except Exception as e:
+        print(f"Error parsing HTML: {e}")
+        return None
+
 
-def get_elements(soup: BeautifulSoup, tag=None, attr=None):
-    return soup.find_all(tag, {attr: True}) if attr else soup.find_all(tag)
+def iter_elements(root, tag=etree.Element):
+    """
+    Iterate over the elements of a parsed HTML document, optionally only those with the given tag.
+    The filtering is done by lxml in C, comments and processing instructions are skipped.
+    """
+    if root is _empty_document:
+        return iter(())
+    # libxml2 keeps content following </html> in further top-level elements next to the root
+    return chain.from_iterable(top.iter(tag) for top in (root, *root.itersiblings()))
 
-def get_tags_f(soup: BeautifulSoup) -> list:
-    #print(soup)
-    if not soup:
-        return [-1] * 53
-    tags = {tag.name: soup.find_all(tag.name) for tag in soup.find_all()}
 
+def get_inline_scripts(root) -> list:
+    """
+    Return the text of the inline scripts of a parsed HTML document.
+    """
     try:
-        anchors = tags.get('a', [])
-        hrefs = [a.get('href') for a in anchors if a.get('href')]
-        hrefs_http = [href for href in hrefs if "http" in href]
-        hrefs_internal = [href for href in hrefs if "http" not in href]
+        return [script.text or '' for script in iter_elements(root, 'script') if script.get('src') is None]
     except Exception as e:
-        anchors, hrefs, hrefs_http, hrefs_internal = [], [], [], []
+        print(f"Error extracting inline scripts: {e}")
+        return None
+
+
+def get_tags_f(root) -> list:
+    if root is None:
+        return [-1] * 53
+
+    tags = Counter()
+    found = {(tag, attr): [] for tag, attrs in _attribute_queries.items() for attr in attrs}
+    anchor_hrefs = []
+    num_of_all_hrefs, num_of_hidden_elements, num_of_input_hidden = 0, 0, 0
+
+    for element in iter_elements(root):
+        tag = element.tag
+        tags[tag] += 1
+
+        # most elements have no style, the substring checks are skipped for them
+        style = element.get('style')
+        hidden_style = style is not None and ('display: none' in style or
+                                              'visibility: hidden' in style or
+                                              'opacity: 0' in style or
+                                              'position: absolute' in style)
+        if element.get('hidden') is not None or hidden_style:
+            num_of_hidden_elements += 1
+        href = element.get('href')
+        if href is not None:
+            num_of_all_hrefs += 1
+
+        if tag == 'a':
+            anchor_hrefs.append(href)
+        elif tag == 'input' and (element.get('type') == 'hidden' or hidden_style):
+            num_of_input_hidden += 1
+
+        for attr in _attribute_queries.get(tag, ()):
+            if element.get(attr) is not None:
+                found[tag, attr].append(element)
+
+    # Every attribute value used by the features below is read only once
+    hrefs = [href for href in anchor_hrefs if href]
+    hrefs_http = [href for href in hrefs if "http" in href]
+    hrefs_internal = [href for href in hrefs if "http" not in href]
+    link_hrefs = [link.get('href') for link in found['link', 'href']]
+    iframe_srcs = [iframe.get('src') for iframe in found['iframe', 'src']]
+    form_actions = [form.get('action') for form in found['form', 'action']]
 
     no_hrefs_flag = len(hrefs) == 0
     external_hrefs_flag = len(hrefs_http) / len(hrefs) > 0.5 if hrefs else 0
     internal_hrefs_flag = len(hrefs_internal) / len(hrefs) <= 0.5 if hrefs else 0
 
-    form_actions = get_elements(soup, 'form', 'action')
-    malicious_form = any("http" in form.get('action', '') or
-                            ".php" in form.get('action', '') or
-                            "#" in form.get('action', '') or
-                            "javascript:void" in form.get('action', '')
-                            for form in form_actions)
-    hidden_elements = [element for element in soup.find_all(True)
-                        if (element.has_attr('hidden') or
-                            'display: none' in element.get('style', '') or
-                            'visibility: hidden' in element.get('style', '') or
-                            'opacity: 0' in element.get('style', '') or
-                            'position: absolute' in element.get('style', ''))]
-
-    hidden_inputs = [input for input in soup.find_all('input')
-                        if input.get('type') == 'hidden' or
-                        'display: none' in input.get('style', '') or
-                        'visibility: hidden' in input.get('style', '') or
-                        'opacity: 0' in input.get('style', '') or
-                        'position: absolute' in input.get('style', '')]
-
-    return [len(tags), len(tags.get('p', [])), len(tags.get('div', [])), len(tags.get('title', [])),
-            len(get_elements(soup, 'script', 'src')),
-            len(get_elements(soup,'link')), len(tags.get('script', [])), len(get_elements(soup,'script', 'async')),
-            len(get_elements(soup,'script', 'type')),
-            len(anchors), len(get_elements(soup,'a', 'href="#"')),
-            len([a for a in anchors if "http" in a.get('href', '')]),
-            len([a for a in anchors if ".com" in a.get('href', '')]),
-            len(tags.get('input', [])), len(get_elements(soup,'input', 'type="password"')), len(hidden_elements),
-            len(hidden_inputs), len(tags.get('object', [])), len(tags.get('embed', [])),
-            len(tags.get('frame', [])), len(tags.get('iframe', [])), len(get_elements(soup,'iframe', 'src')),
-            len([iframe for iframe in get_elements(soup,'iframe', 'src') if "http" in iframe.get('src', '')]),
-            len(tags.get('center', [])), len(tags.get('img', [])), len(get_elements(soup,'img', 'src')),
-            len(tags.get('meta', [])), len(get_elements(soup,'link', 'href')),
-            len([link for link in get_elements(soup,'link', 'href') if "http" in link.get('href', '')]),
-            len([link for link in get_elements(soup,'link', 'href') if ".css" in link.get('href', '')]),
-            len(get_elements(soup,'link', 'type')), len(get_elements(soup,'link', 'type="application/rss+xml"')),
-            len(get_elements(soup,'link', 'rel="shortlink"')), len(soup.find_all(href=True)),
-            len(form_actions), len([form for form in form_actions if "http" in form.get('action', '')]),
-            len(tags.get('strong', [])), int(no_hrefs_flag), int(internal_hrefs_flag), len(hrefs_internal), int(external_hrefs_flag),
-            len(hrefs_http), len(get_elements(soup,'link', 'rel="shortcut icon"')), int(bool(
-            [icon for icon in get_elements(soup,'link', 'rel="shortcut icon"') if "http" in icon.get('href', '')])),
-            len([form for form in form_actions if ".php" in form.get('action', '')]),
-            len([form for form in form_actions if "#" in form.get('action', '')]),
-            len([form for form in form_actions if
-                    "javascript:void()" in form.get('action', '') or "javascript:void(0)" in form.get('action', '')]),
+    malicious_form = any("http" in action or
+                            ".php" in action or
+                            "#" in action or
+                            "javascript:void" in action
+                            for action in form_actions)
+
+    return [len(tags), tags['p'], tags['div'], tags['title'],
+            len(found['script', 'src']),
+            tags['link'], tags['script'], len(found['script', 'async']),
+            len(found['script', 'type']),
+            tags['a'], len(found['a', 'href="#"']),
+            len(hrefs_http),
+            len([href for href in hrefs if ".com" in href]),
+            tags['input'], len(found['input', 'type="password"']), num_of_hidden_elements,
+            num_of_input_hidden, tags['object'], tags['embed'],
+            tags['frame'], tags['iframe'], len(found['iframe', 'src']),
+            len([src for src in iframe_srcs if "http" in src]),
+            tags['center'], tags['img'], len(found['img', 'src']),
+            tags['meta'], len(link_hrefs),
+            len([href for href in link_hrefs if "http" in href]),
+            len([href for href in link_hrefs if ".css" in href]),
+            len(found['link', 'type']), len(found['link', 'type="application/rss+xml"']),
+            len(found['link', 'rel="shortlink"']), num_of_all_hrefs,
+            len(form_actions), len([action for action in form_actions if "http" in action]),
+            tags['strong'], int(no_hrefs_flag), int(internal_hrefs_flag), len(hrefs_internal), int(external_hrefs_flag),
+            len(hrefs_http), len(found['link', 'rel="shortcut icon"']), int(bool(
+            [icon for icon in found['link', 'rel="shortcut icon"'] if "http" in icon.get('href', '')])),
+            len([action for action in form_actions if ".php" in action]),
+            len([action for action in form_actions if "#" in action]),
+            len([action for action in form_actions if
+                    "javascript:void()" in action or "javascript:void(0)" in action]),
             int(malicious_form),
-            Counter(hrefs).most_common(1)[0][1] / len(hrefs) if hrefs else 0,
-            len([css for css in get_elements(soup,'link', 'rel="stylesheet"') if "http" not in css.get('href', '')]),
-            len([css for css in get_elements(soup,'link', 'rel="stylesheet"') if "http" in css.get('href', '')]),
-            len(get_elements(soup,'a', 'href="#content"')), len(get_elements(soup,'a', 'href="javascript:void(0)"'))
+            max(Counter(hrefs).values()) / len(hrefs) if hrefs else 0,
+            len([css for css in found['link', 'rel="stylesheet"'] if "http" not in css.get('href', '')]),
+            len([css for css in found['link', 'rel="stylesheet"'] if "http" in css.get('href', '')]),
+            len(found['a', 'href="#content"']), len(found['a', 'href="javascript:void(0)"'])
             ]
 
 
-def get_text_f(html: str) -> tuple[int, int, int, float, int, int]:
-    if html is None or html == 'None':
-        return -1, -1, -1, -1, -1, -1
-    try:
-        words = html.split()
-        html_num_of_words = len(words)
-        html_num_of_lines = len(html.splitlines())
-        html_unique_words = len(set(words))
-        html_average_word_len = sum(len(word) for word in words) / len(words) if words else 0
-    except Exception as e:
-        html_num_of_words, html_num_of_lines, html_unique_words, html_average_word_len = 0, 0, 0, 0
-
-    patterns = _text_patterns
-    try:
-        html_num_of_blank_spaces = len(patterns[1].findall(html))
-    except Exception as e:
-        html_num_of_blank_spaces = 0
-    try:
-        blocked_keywords_count = len(patterns[0].findall(html))
-    except Exception as e:
-        blocked_keywords_count = 0
-
-    if blocked_keywords_count > 0:
-        html_blocked_keywords_label = 1
-    else:
-        html_blocked_keywords_label = 0
-
-    return (html_num_of_words, html_num_of_lines, html_unique_words, html_average_word_len,
-            html_blocked_keywords_label, html_num_of_blank_spaces)
+def get_text_f(htmls: Series) -> DataFrame:
+    """
+    Compute the text features of a column of decompressed HTML documents with Arrow's string
+    kernels. Missing documents get -1 in all the features.
+    """
+    text = pa.array(htmls.where(htmls != 'None', None), pa.large_string())
+    missing = text.is_null().to_numpy(zero_copy_only=False)
+    text = pc.fill_null(text, "")
+
+    # Leading and trailing whitespace yields empty words, which str.split() leaves out
+    words = pc.utf8_split_whitespace(text)
+    words = pa.table({"row": pc.list_parent_indices(words), "word": pc.list_flatten(words)})
+    words = words.append_column("length", pc.utf8_length(words["word"]))
+    word_stats = words.filter(pc.greater(words["length"], 0)).group_by("row").aggregate(
+        [("word", "count"), ("word", "count_distinct"), ("length", "sum")])
+    rows = word_stats["row"].to_numpy()
+    num_of_words = np.zeros(len(text), dtype=np.int64)
+    num_of_words[rows] = word_stats["word_count"].to_numpy()
+    unique_words = np.zeros(len(text), dtype=np.int64)
+    unique_words[rows] = word_stats["word_count_distinct"].to_numpy()
+    words_length = np.zeros(len(text), dtype=np.int64)
+    words_length[rows] = word_stats["length_sum"].to_numpy()
+
+    # str.splitlines() yields a line per line break plus one for unterminated text at the end
+    num_of_lines = (pc.count_substring_regex(text, _text_patterns["line_break"]).to_numpy() +
+                    pc.and_not(pc.greater(pc.utf8_length(text), 0),
+                               pc.match_substring_regex(text, _text_patterns["trailing_line_break"])).to_numpy(
+                        zero_copy_only=False))
+    blocked_keywords_label = pc.match_substring_regex(text, _text_patterns["blocked_keywords"], ignore_case=True)
+    num_of_blank_spaces = pc.count_substring_regex(text, _text_patterns["blank_spaces"]).to_numpy()
+
+    features = DataFrame({
+        "html_num_of_words": num_of_words,
+        "html_num_of_lines": num_of_lines.astype(np.int64),
+        "html_unique_words": unique_words,
+        "html_average_word_len": np.divide(words_length, num_of_words, out=np.zeros(len(text)),
+                                           where=num_of_words > 0),
+        "html_blocked_keywords_label": blocked_keywords_label.to_numpy(zero_copy_only=False).astype(np.int64),
+        "html_num_of_blank_spaces": num_of_blank_spaces.astype(np.int64)
+    }, index=htmls.index)
+    features[missing] = -1
+
+    return features
 
 
 def get_js_f(js: list) -> Iterable[int | float]:
     if js is None:
-        return[-1] * (len(_patterns))
+        return[-1] * (len(_js_features))
     if not js:
-        return [0] * (len(_patterns))
+        return [0] * (len(_js_features))
+
+    dic: dict[str, int | float] = {key: 0 for key in _js_features}
+    scripts = "\n".join(map(str, js))
 
-    regex_patterns = _patterns
-    dic: dict[str, int | float] = {key: 0 for key in regex_patterns.keys()}
+    for key, call in _js_calls.items():
+        dic[key] = scripts.count(call)
+    dic["escape"] -= scripts.count(_js_escape_exclusion)
 
-    for script in js:
-        for key, pattern in regex_patterns.items():
-            dic[key] += len(pattern.findall(str(script)))
+    for match in _js_encodings_pattern.finditer(scripts):
+        dic[match.lastgroup] += 1
+    dic["longVariableName"] = len(_js_long_variable_name_pattern.findall(scripts))
 
     return dic.values()
 
-def para_transform_chunk(chunk: DataFrame, chunk_index: int, timeout_seconds=440) -> DataFrame:
-    try:
-        with Timeout(timeout_seconds):
-            print(f"[INFO] Processing chunk {chunk_index} with {len(chunk)} rows...")
-            chunk['html_decompressed'] = chunk['html'].apply(
-                lambda x: decompress_html(x['compressed_html']) if x and 'compressed_html' in x and x['compressed_html'] else None)
-            chunk['soup'] = chunk['html_decompressed'].apply(lambda html: BeautifulSoup(html, 'html.parser') if notnull(html) else None)
-            chunk['js_inline'] = chunk['soup'].apply(
-                lambda soup: [script for script in soup.find_all('script') if not script.has_attr('src')] if soup else None)
-
-            (chunk["html_num_of_tags"], chunk["html_num_of_paragraphs"], chunk["html_num_of_divs"], chunk["html_num_of_titles"],
-                chunk["html_num_of_external_js"],
-                chunk["html_num_of_links"], chunk["html_num_of_scripts"], chunk["html_num_of_scripts_async"],
-                chunk["html_num_of_scripts_type"], chunk["html_num_of_anchors"],
-                chunk["html_num_of_anchors_to_hash"], chunk["html_num_of_anchors_to_https"], chunk["html_num_of_anchors_to_com"],
-                chunk["html_num_of_inputs"], chunk["html_num_of_input_password"],
-                chunk["html_num_of_hidden_elements"], chunk["html_num_of_input_hidden"], chunk["html_num_of_objects"],
-                chunk["html_num_of_embeds"], chunk["html_num_of_frame"],
-                chunk["html_num_of_iframe"], chunk["html_num_of_iframe_src"], chunk["html_num_of_iframe_src_https"],
-                chunk["html_num_of_center"], chunk["html_num_of_imgs"],
-                chunk["html_num_of_imgs_src"], chunk["html_num_of_meta"], chunk["html_num_of_links_href"],
-                chunk["html_num_of_links_href_https"], chunk["html_num_of_links_href_css"],
-                chunk["html_num_of_links_type"], chunk["html_num_of_link_type_app"], chunk["html_num_of_link_rel"],
-                chunk["html_num_of_all_hrefs"], chunk["html_num_of_form_action"],
-                chunk["html_num_of_form_http"], chunk["html_num_of_strong"], chunk["html_no_hrefs"], chunk["html_internal_href_ratio"],
-                chunk["html_num_of_internal_hrefs"],
-                chunk["html_external_href_ratio"], chunk["html_num_of_external_href"], chunk["html_num_of_icon"],
-                chunk["html_icon_external"], chunk["html_num_of_form_php"],
-                chunk["html_num_of_form_hash"], chunk["html_num_of_form_js"], chunk["html_malicious_form"], chunk["html_most_common"],
-                chunk["html_num_of_css_internal"], chunk["html_num_of_css_external"],
-                chunk["html_num_of_anchors_to_content"], chunk["html_num_of_anchors_to_void"]) = zip(
-                *chunk["soup"].apply(get_tags_f))
-
-            chunk["html_num_of_words"], chunk["html_num_of_lines"], chunk["html_unique_words"], chunk["html_average_word_len"], chunk[
-                "html_blocked_keywords_label"], chunk["html_num_of_blank_spaces"] = zip(*chunk["html_decompressed"].apply(get_text_f))
-
-            (chunk["html_create_element"], chunk["html_write"], chunk["html_char_code_at"], chunk["html_concat"], chunk["html_escape"],
-                chunk["html_eval"],
-                chunk["html_exec"], chunk["html_from_char_code"], chunk["html_link"], chunk["html_parse_int"], chunk["html_replace"],
-                chunk["html_search"],
-                chunk["html_substring"], chunk["html_unescape"], chunk["html_add_event_listener"], chunk["html_set_interval"],
-                chunk["html_set_timeout"],
-                chunk["html_push"], chunk["html_index_of"], chunk["html_document_write"], chunk["html_get"], chunk["html_find"],
-                chunk["html_document_create_element"],
-                chunk["html_window_set_timeout"], chunk["html_window_set_interval"], chunk["html_hex_encoding"],
-                chunk["html_unicode_encoding"],
-                chunk["html_long_variable_name"]) = zip(*chunk["js_inline"].apply(get_js_f))
-
-            # Drop intermediate columns to free memory
-            chunk.drop(columns=["html_decompressed", "soup", "js_inline"], inplace=True)
-            print(f"[INFO] Finished processing chunk {chunk_index}.")
-            return chunk
-    except TimeoutError:
-        print(f"[WARN] Chunk {chunk_index} timed out. Filling HTML features with -1.")
-        chunk[HTML_FEATURE_COLUMNS] = -1
+def apply_per_row(values: Series, get_f, num_features: int) -> list:
+    """
+    Apply a feature function to every document, a document it fails on gets -1 for all of
+    the function's features instead of failing the whole chunk.
+    """
+    features = []
+    for value in values:
         try:
-            chunk.drop(columns=["html_decompressed", "soup", "js_inline"], errors="ignore", inplace=True)
-            return chunk
-        except:
-            print("NO SUCH COLS")
-            return chunk
+            features.append(get_f(value))
+        except Exception as e:
+            print(f"Error extracting HTML features: {e}")
+            features.append([-1] * num_features)
+    return features
+
+def para_transform_chunk(chunk: DataFrame, chunk_index: int) -> DataFrame:
+    print(f"[INFO] Processing chunk {chunk_index} with {len(chunk)} rows...")
+    with ThreadPoolExecutor(max_workers=DECOMPRESS_THREADS) as executor:
+        chunk['html_decompressed'] = list(executor.map(decompress_html, chunk['compressed_html']))
+    chunk['tree'] = chunk['html_decompressed'].apply(lambda html: parse_html(html) if notnull(html) else None)
+    chunk['js_inline'] = chunk['tree'].apply(lambda root: get_inline_scripts(root) if root is not None else None)
+
+    (chunk["html_num_of_tags"], chunk["html_num_of_paragraphs"], chunk["html_num_of_divs"], chunk["html_num_of_titles"],
+        chunk["html_num_of_external_js"],
+        chunk["html_num_of_links"], chunk["html_num_of_scripts"], chunk["html_num_of_scripts_async"],
+        chunk["html_num_of_scripts_type"], chunk["html_num_of_anchors"],
+        chunk["html_num_of_anchors_to_hash"], chunk["html_num_of_anchors_to_https"], chunk["html_num_of_anchors_to_com"],
+        chunk["html_num_of_inputs"], chunk["html_num_of_input_password"],
+        chunk["html_num_of_hidden_elements"], chunk["html_num_of_input_hidden"], chunk["html_num_of_objects"],
+        chunk["html_num_of_embeds"], chunk["html_num_of_frame"],
+        chunk["html_num_of_iframe"], chunk["html_num_of_iframe_src"], chunk["html_num_of_iframe_src_https"],
+        chunk["html_num_of_center"], chunk["html_num_of_imgs"],
+        chunk["html_num_of_imgs_src"], chunk["html_num_of_meta"], chunk["html_num_of_links_href"],
+        chunk["html_num_of_links_href_https"], chunk["html_num_of_links_href_css"],
+        chunk["html_num_of_links_type"], chunk["html_num_of_link_type_app"], chunk["html_num_of_link_rel"],
+        chunk["html_num_of_all_hrefs"], chunk["html_num_of_form_action"],
+        chunk["html_num_of_form_http"], chunk["html_num_of_strong"], chunk["html_no_hrefs"], chunk["html_internal_href_ratio"],
+        chunk["html_num_of_internal_hrefs"],
+        chunk["html_external_href_ratio"], chunk["html_num_of_external_href"], chunk["html_num_of_icon"],
+        chunk["html_icon_external"], chunk["html_num_of_form_php"],
+        chunk["html_num_of_form_hash"], chunk["html_num_of_form_js"], chunk["html_malicious_form"], chunk["html_most_common"],
+        chunk["html_num_of_css_internal"], chunk["html_num_of_css_external"],
+        chunk["html_num_of_anchors_to_content"], chunk["html_num_of_anchors_to_void"]) = zip(
+        *apply_per_row(chunk["tree"], get_tags_f, 53))
+
+    text_features = get_text_f(chunk["html_decompressed"])
+    chunk[text_features.columns] = text_features
+
+    (chunk["html_create_element"], chunk["html_write"], chunk["html_char_code_at"], chunk["html_concat"], chunk["html_escape"],
+        chunk["html_eval"],
+        chunk["html_exec"], chunk["html_from_char_code"], chunk["html_link"], chunk["html_parse_int"], chunk["html_replace"],
+        chunk["html_search"],
+        chunk["html_substring"], chunk["html_unescape"], chunk["html_add_event_listener"], chunk["html_set_interval"],
+        chunk["html_set_timeout"],
+        chunk["html_push"], chunk["html_index_of"], chunk["html_document_write"], chunk["html_get"], chunk["html_find"],
+        chunk["html_document_create_element"],
+        chunk["html_window_set_timeout"], chunk["html_window_set_interval"], chunk["html_hex_encoding"],
+        chunk["html_unicode_encoding"],
+        chunk["html_long_variable_name"]) = zip(*apply_per_row(chunk["js_inline"], get_js_f, len(_js_features)))
+
+    print(f"[INFO] Finished processing chunk {chunk_index}.")
+    # Only the features are sent back, the intermediate columns are freed with the chunk
+    return chunk[HTML_FEATURE_COLUMNS]
+
+# chunks of compressed HTML bytes per worker, the workers pick up the next chunk as they finish
+CHUNKS_PER_JOB = 4
+
+# tmpfs backing POSIX shared memory on Linux, often small in containers (64 MB by default in Docker)
+SHM_PATH = '/dev/shm'
+
+_shared_chunk_schema = pa.schema([('compressed_html', pa.large_binary())])
+
+def chunk_bounds(sizes: list, target_bytes: float, max_rows: int) -> list:
+    """
+    Greedily split consecutive rows into chunks of about target_bytes of payload each,
+    with at most max_rows rows per chunk, and return the (start, stop) bounds of the chunks.
+    """
+    bounds = []
+    start, chunk_bytes = 0, 0
+    for i, size in enumerate(sizes):
+        chunk_bytes += size
+        if chunk_bytes >= target_bytes or i + 1 - start == max_rows:
+            bounds.append((start, i + 1))
+            start, chunk_bytes = i + 1, 0
+    if start < len(sizes):
+        bounds.append((start, len(sizes)))
+    return bounds
+
+def share_chunks(payloads: list, bounds: list) -> tuple[SharedMemory, int] | None:
+    """
+    Write the compressed HTML payloads as an Arrow IPC file with one record batch per chunk
+    into a new shared memory block, so that the workers can map their chunk instead of
+    receiving it pickled. Return the block and the size of the file in it, or None if
+    there is no room for the file in the shared memory.
+    """
+    batches = [pa.record_batch([pa.array(payloads[start:stop], pa.large_binary())], schema=_shared_chunk_schema)
+               for start, stop in bounds]
+
+    def write(sink):
+        with pa.ipc.new_file(sink, _shared_chunk_schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+    # Measure the file first so that it is serialized straight into the shared block
+    mock_sink = pa.MockOutputStream()
+    write(mock_sink)
+    size = mock_sink.size()
+    # Creating the block succeeds at any size, writing past the end of the tmpfs kills the process with SIGBUS
+    if os.path.isdir(SHM_PATH) and shutil.disk_usage(SHM_PATH).free < size:
+        print(f"[WARN] {size} bytes of HTML do not fit into {SHM_PATH} (raise e.g. Docker's --shm-size), "
+              "passing the chunks to the workers directly.")
+        return None
+    shm = SharedMemory(create=True, size=size)
+    write(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)))
+    return shm, size
+
+def read_shared_chunk(shm: SharedMemory, size: int, chunk_index: int) -> list:
+    # The block may be rounded up to whole pages, the file footer is located from the end of the file
+    with pa.ipc.open_file(pa.py_buffer(shm.buf[:size])) as reader:
+        return reader.get_batch(chunk_index).column(0).to_pylist()
+
+def para_transform_shared_chunk(shm_name: str, size: int, chunk_index: int) -> DataFrame:
+    # loky workers share the parent's resource tracker, the block is unlinked by the parent only
+    shm = SharedMemory(name=shm_name)
+    try:
+        payloads = read_shared_chunk(shm, size, chunk_index)
+    finally:
+        shm.close()
+    return para_transform_chunk(DataFrame({'compressed_html': payloads}), chunk_index + 1)
 
 #optimize the function parameters based on the system parameters
-def transform_html(df: DataFrame, chunk_size=200, n_jobs=11, timeout_seconds=440) -> DataFrame:
-    # Split the DataFrame into chunks
-    num_chunks = len(df) // chunk_size + (1 if len(df) % chunk_size != 0 else 0)
-    chunks = [df.iloc[i * chunk_size: (i + 1) * chunk_size].copy() for i in range(num_chunks)]
-    print("Number of chunks: ",len(chunks))
-    processed_chunks = Parallel(n_jobs=n_jobs, backend='loky')(
-        delayed(para_transform_chunk)(chunk, idx + 1, timeout_seconds) for idx, chunk in enumerate(chunks)
-    )
-
-    concatenated_df = concat(processed_chunks, ignore_index=True)
-
-    if 'html' in concatenated_df.columns:
-        concatenated_df = concatenated_df.drop(columns=['html'])
-    
+def transform_html(df: DataFrame, chunk_size=200, n_jobs=11) -> DataFrame:
+    # Only the compressed HTML is needed by the workers, it is shared with them in chunks;
+    # a missing payload is left empty, which decompresses to no HTML just like None
+    payloads = [x['compressed_html'] if x and 'compressed_html' in x and x['compressed_html'] else b''
+                for x in df['html']]
+    # Templated pages (e.g. parked domains) repeat the same payload, each distinct one is processed once
+    codes, payloads = factorize(np.array(payloads, dtype=object))
+    print(f"Unique HTML payloads: {len(payloads)} of {len(df)}")
+    # Page sizes vary by orders of magnitude, so the chunks are balanced by their compressed size
+    # rather than by rows: a chunk holds about as many bytes as chunk_size pages of average size,
+    # fewer if needed to give every worker CHUNKS_PER_JOB chunks to even out the load
+    sizes = [len(payload) for payload in payloads]
+    total_bytes = sum(sizes)
+    chunk_bytes = min(total_bytes / (effective_n_jobs(n_jobs) * CHUNKS_PER_JOB),
+                      chunk_size * total_bytes / max(len(sizes), 1))
+    bounds = chunk_bounds(sizes, chunk_bytes, chunk_size)
+    num_chunks = len(bounds)
+    print("Number of chunks: ", num_chunks)
+    shared = share_chunks(list(payloads), bounds)
+    if shared is None:
+        processed_chunks = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(para_transform_chunk)(DataFrame({'compressed_html': payloads[start:stop]}), idx + 1)
+            for idx, (start, stop) in enumerate(bounds)
+        )
+    else:
+        del payloads
+        shm, size = shared
+        try:
+            processed_chunks = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(para_transform_shared_chunk)(shm.name, size, idx) for idx in range(num_chunks)
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+    features = concat(processed_chunks, ignore_index=True).take(codes).reset_index(drop=True)
+    concatenated_df = concat([df.drop(columns=['html']).reset_index(drop=True), features], axis=1)
+
     return concatenated_df
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 
 import os
-import random
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, WriteConcern
 from dotenv import load_dotenv
-import subprocess
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,21 +19,68 @@ db_name = os.getenv('DR_DB_NAME', 'drdb')
 client = MongoClient(mongo_uri)
 db = client[db_name]
 
-def is_domain_live(domain, timeout, verbose):
-    if verbose:
-        print(f"Checking if domain {domain} is live with timeout {timeout}...")
+# A domain is live if it accepts a TCP connection on any of these ports
+LIVECHECK_PORTS = (80, 443)
+# Documents per insert_many call when filling the target collection
+INSERT_BATCH_SIZE = 1000
+
+async def accepts_connection(domain, port, timeout):
     try:
-        result = subprocess.run(['ping', '-c', '1', '-W', str(timeout), domain], stdout=subprocess.DEVNULL)
-        live = result.returncode == 0
-        if verbose:
-            print(f"Domain {domain} is {'live' if live else 'not live'}.")
-        return live
-    except Exception as e:
-        if verbose:
-            print(f"Error checking domain {domain}: {e}")
+        _, writer = await asyncio.wait_for(asyncio.open_connection(domain, port), timeout)
+    except Exception:
         return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass
+    return True
+
+async def is_domain_live(domain, timeout, verbose):
+    if verbose:
+        print(f"Checking if domain {domain} is live with timeout {timeout}...")
+    live = any(await asyncio.gather(*(accepts_connection(domain, port, timeout) for port in LIVECHECK_PORTS)))
+    if verbose:
+        print(f"Domain {domain} is {'live' if live else 'not live'}.")
+    return live
+
+async def check_domains_live(domains, timeout, verbose):
+    # Name resolution runs in the default executor, give every probe a thread so that
+    # lookups do not queue up and eat the connection timeout
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max(1, len(domains) * len(LIVECHECK_PORTS))))
+    return await asyncio.gather(*(is_domain_live(domain, timeout, verbose) for domain in domains))
 
-def main(source, target, n, livecheck, exclude=None, timeout=1, verbose=True):
+def sample_candidates(collection, size, exclude_domains, seen):
+    # Excluded domains are dropped here rather than on the server, and $sample may return
+    # a document more than once, so samples are drawn until there are enough new candidates
+    # or a sample of the whole collection brings no new domain, i.e. the collection is exhausted
+    total = collection.estimated_document_count()
+    candidates = []
+    new_total = 0
+    draw = size
+    while len(candidates) < size:
+        new_domains = 0
+        for doc in collection.aggregate([{'$sample': {'size': draw}}], allowDiskUse=True, batchSize=1000):
+            if doc['domain_name'] in seen:
+                continue
+            seen.add(doc['domain_name'])
+            new_domains += 1
+            if doc['domain_name'] not in exclude_domains:
+                candidates.append(doc)
+        if new_domains == 0:
+            # Near the end of the collection a small sample may repeat only seen domains
+            if draw >= total:
+                break
+            draw = min(draw * 2, total)
+            continue
+        new_total += new_domains
+        # Enlarge the next sample by the share of excluded domains drawn so far
+        remaining = size - len(candidates)
+        draw = min(-(-remaining * new_total // max(len(candidates), 1)), remaining + len(exclude_domains))
+    return candidates
+
+def main(source, target, n, livecheck, exclude=None, timeout=1, verbose=True, oversample=2.0, concurrency=256):
     if verbose:
         print("Connecting to MongoDB...")
     
@@ -43,43 +90,59 @@ def main(source, target, n, livecheck, exclude=None, timeout=1, verbose=True):
     exclude_domains = set()
     if exclude:
         exclude_collection = db[exclude]
-        exclude_domains = set(doc['domain_name'] for doc in exclude_collection.find({}, {'domain_name': 1}))
+        cursor = exclude_collection.find({}, {'domain_name': 1, '_id': 0}).batch_size(10000)
+        exclude_domains = {doc['domain_name'] for doc in cursor}
         if verbose:
             print(f"Loaded {len(exclude_domains)} domains from exclude collection.")
 
-    candidates = [doc for doc in source_collection.find({'domain_name': {'$nin': list(exclude_domains)}})]
-    random.shuffle(candidates)
-    if verbose:
-        print(f"Found {len(candidates)} candidate domains in source collection.")
-    
-    if len(candidates) < n:
-        print(f"Warning: Not enough candidates available. Needed: {n}, Found: {len(candidates)}")
-
     selected_domains = []
     excluded_domains = len(exclude_domains)
     nonlive_domains = 0
+    seen = set()
 
-    for index, candidate in enumerate(candidates):
-        if len(selected_domains) >= n:
+    # Candidates are drawn until n of them are selected or the collection is exhausted
+    while len(selected_domains) < n:
+        # Let the server draw the random candidates, oversampled to make up for non-live domains
+        shortfall = n - len(selected_domains)
+        sample_size = max(1, int(shortfall * oversample)) if livecheck else shortfall
+        candidates = sample_candidates(source_collection, sample_size, exclude_domains, seen)
+        if verbose:
+            print(f"Found {len(candidates)} candidate domains in source collection.")
+        if not candidates:
             break
-        if candidate['domain_name'] not in exclude_domains:
+
+        # Candidates are live-checked concurrently, one window at a time
+        processed = 0
+        while processed < len(candidates) and len(selected_domains) < n:
+            window = candidates[processed:processed + concurrency]
             if livecheck:
-                if is_domain_live(candidate['domain_name'], timeout, verbose):
+                live = asyncio.run(check_domains_live([candidate['domain_name'] for candidate in window], timeout, verbose))
+            else:
+                live = [True] * len(window)
+
+            for candidate, candidate_live in zip(window, live):
+                if len(selected_domains) >= n:
+                    break
+                if candidate_live:
                     selected_domains.append(candidate)
                 else:
                     nonlive_domains += 1
-            else:
-                selected_domains.append(candidate)
 
-        if verbose:
-            processed = index + 1
-            remaining = len(candidates) - processed
-            print(f"Processed: {processed}, Selected: {len(selected_domains)}, Non-live: {nonlive_domains}, Remaining: {remaining}")
+                processed += 1
+                if verbose:
+                    remaining = len(candidates) - processed
+                    print(f"Processed: {processed}, Selected: {len(selected_domains)}, Non-live: {nonlive_domains}, Remaining: {remaining}")
+
+    if len(selected_domains) < n:
+        print(f"Warning: Not enough domains available. Needed: {n}, Found: {len(selected_domains)}")
 
     if verbose:
         print(f"Inserting {len(selected_domains)} domains into target collection...")
     if selected_domains:
-        target_collection.insert_many(selected_domains)
+        # Unordered and unacknowledged inserts do not wait for a server round trip per batch
+        unacknowledged_collection = target_collection.with_options(write_concern=WriteConcern(w=0))
+        for start in range(0, len(selected_domains), INSERT_BATCH_SIZE):
+            unacknowledged_collection.insert_many(selected_domains[start:start + INSERT_BATCH_SIZE], ordered=False)
 
     print(f"Selected domains: {len(selected_domains)}")
     print(f"Excluded domains: {excluded_domains}")
@@ -92,8 +155,10 @@ if __name__ == "__main__":
     parser.add_argument('n', type=int, help='The number of desired rows.')
     parser.add_argument('--exclude', type=str, help='The name of the exclude collection (optional).')
     parser.add_argument('--livecheck', action='store_true', help='Check if the domain names are live.')
-    parser.add_argument('--timeout', type=int, default=1, help='Specify the ping timeout in seconds (default is 1).')
+    parser.add_argument('--timeout', type=int, default=1, help='Specify the live check connection timeout in seconds (default is 1).')
+    parser.add_argument('--concurrency', type=int, default=256, help='Number of domains live-checked concurrently (default is 256).')
+    parser.add_argument('--oversample', type=float, default=2.0, help='Number of candidates sampled per desired row with --livecheck (default is 2.0).')
     parser.add_argument('--verbose', type=int, choices=[0, 1], default=1, help='Enable verbose mode (default is 1).')
 
     args = parser.parse_args()
-    main(args.source, args.target, args.n, args.livecheck, args.exclude, args.timeout, args.verbose == 1)
+    main(args.source, args.target, args.n, args.livecheck, args.exclude, args.timeout, args.verbose == 1, args.oversample, args.concurrency)